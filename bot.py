@@ -1,12 +1,19 @@
 import asyncio
 import logging
 import os
+import heapq
 import json
-from typing import Dict, List, Optional
-from datetime import datetime, timedelta
-from telegram import Update
+import math
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Deque, Dict, Iterator, List, Optional, Set, Tuple
+from telegram import Message, Update
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.generativeai.types import BlockedPromptException, StopCandidateException
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения
@@ -27,9 +34,13 @@ class Config:
     TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
     MAX_CONVERSATION_LENGTH = int(os.getenv("MAX_CONVERSATION_LENGTH", "20"))
+    MAX_ACTIVE_CONVERSATIONS = int(os.getenv("MAX_ACTIVE_CONVERSATIONS", "10000"))
+    MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "30000"))
+    SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gemini-2.5-flash")
     MAX_MESSAGE_LENGTH = int(os.getenv("MAX_MESSAGE_LENGTH", "4000"))
     RATE_LIMIT_MINUTES = int(os.getenv("RATE_LIMIT_MINUTES", "1"))
     RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "15"))
+    COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "0"))
     
     @classmethod
     def validate(cls):
@@ -38,97 +49,360 @@ class Config:
             raise ValueError("❌ Отсутствуют обязательные переменные окружения: TELEGRAM_BOT_TOKEN, GEMINI_API_KEY")
         logger.info("✅ Конфигурация валидна")
 
+class ExpiryIndex:
+    """Индекс истечения: куча (срок, user_id) с ленивым удалением устаревших записей"""
+    # Запас устаревших записей в куче сверх удвоенного числа пользователей
+    SLACK = 64
+    
+    def __init__(self):
+        self._heap: List[Tuple[float, int]] = []
+        # Актуальный срок пользователя; записи кучи с другим сроком устарели
+        self._deadlines: Dict[int, float] = {}
+    
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._deadlines
+    
+    def schedule(self, user_id: int, deadline: float):
+        """Постановка (или перенос) срока пользователя"""
+        self._deadlines[user_id] = deadline
+        # Удалённые пользователи оставляют в куче устаревшие записи;
+        # когда их становится больше живых, пересобираем кучу из актуальных сроков
+        if len(self._heap) > 2 * len(self._deadlines) + self.SLACK:
+            self._heap = [(d, uid) for uid, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        else:
+            heapq.heappush(self._heap, (deadline, user_id))
+    
+    def discard(self, user_id: int):
+        """Снятие пользователя с учёта (запись в куче станет устаревшей)"""
+        self._deadlines.pop(user_id, None)
+    
+    def pop_due(self, now: float) -> Iterator[int]:
+        """Пользователи с истёкшим сроком; каждый снимается с учёта перед выдачей"""
+        # Разбираем только истёкшие записи кучи, а не всех пользователей
+        while self._heap and self._heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self._heap)
+            if self._deadlines.get(user_id) != deadline:
+                continue  # Устаревшая запись
+            del self._deadlines[user_id]
+            yield user_id
+
 class RateLimiter:
-    """Ограничитель частоты запросов"""
+    """Ограничитель частоты запросов (token bucket)"""
     def __init__(self):
-        self.user_requests: Dict[int, List[datetime]] = {}
+        # Корзина пользователя: (доступные запросы, время последнего пополнения).
+        # Две float на пользователя вместо списка меток времени
+        self.buckets: Dict[int, Tuple[float, float]] = {}
+        self._expiry = ExpiryIndex()
+    
+    @staticmethod
+    def _window() -> float:
+        """Окно лимита в секундах: за это время корзина наполняется полностью"""
+        return max(Config.RATE_LIMIT_MINUTES * 60, 1)
     
     def is_allowed(self, user_id: int) -> bool:
         """Проверка лимита запросов"""
-        now = datetime.now()
-        cutoff = now - timedelta(minutes=Config.RATE_LIMIT_MINUTES)
+        now = time.monotonic()
+        capacity = Config.RATE_LIMIT_REQUESTS
+        window = self._window()
         
-        if user_id not in self.user_requests:
-            self.user_requests[user_id] = []
-        
-        # Очищаем старые запросы
-        self.user_requests[user_id] = [
-            req_time for req_time in self.user_requests[user_id] 
-            if req_time > cutoff
-        ]
+        # Пополняем корзину пропорционально прошедшему времени
+        tokens, last = self.buckets.get(user_id, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * capacity / window)
         
         # Проверяем лимит
-        if len(self.user_requests[user_id]) >= Config.RATE_LIMIT_REQUESTS:
+        if tokens < 1:
+            if user_id in self.buckets:
+                self.buckets[user_id] = (tokens, now)
             return False
         
-        # Добавляем новый запрос
-        self.user_requests[user_id].append(now)
+        # Списываем запрос
+        if user_id not in self._expiry:
+            self._expiry.schedule(user_id, now + window)
+        self.buckets[user_id] = (tokens - 1, now)
         return True
     
     def cleanup_old_data(self):
         """Очистка старых данных для экономии памяти"""
-        cutoff = datetime.now() - timedelta(hours=1)
-        users_to_remove = []
-        
-        for user_id, requests in self.user_requests.items():
-            self.user_requests[user_id] = [
-                req_time for req_time in requests if req_time > cutoff
-            ]
-            if not self.user_requests[user_id]:
-                users_to_remove.append(user_id)
-        
-        for user_id in users_to_remove:
-            del self.user_requests[user_id]
+        now = time.monotonic()
+        capacity = Config.RATE_LIMIT_REQUESTS
+        window = self._window()
+        
+        for user_id in self._expiry.pop_due(now):
+            # Полная корзина ничем не отличается от отсутствующей
+            tokens, last = self.buckets[user_id]
+            full_at = last + (capacity - tokens) * window / max(capacity, 1)
+            if full_at > now:
+                self._expiry.schedule(user_id, full_at)
+            else:
+                del self.buckets[user_id]
+
+class TokenEstimator:
+    """Локальная оценка числа токенов, калибруемая по точным счётчикам Gemini"""
+    CHARS_PER_TOKEN = 4
+    # Доля нового замера в скользящем среднем и допустимые пределы поправки
+    SMOOTHING = 0.2
+    MIN_SCALE = 0.5
+    MAX_SCALE = 4.0
+    
+    def __init__(self):
+        # Поправка к базовой оценке chars/4 (для кириллицы обычно > 1)
+        self.scale = 1.0
+    
+    def estimate(self, text: str) -> int:
+        """Оценка токенов без обращения к API"""
+        return int(len(text) / self.CHARS_PER_TOKEN * self.scale) + 1
+    
+    def calibrate(self, text: str, actual_tokens: int):
+        """Подстройка поправки по тексту с известным точным числом токенов"""
+        if not text or actual_tokens <= 0:
+            return
+        target = actual_tokens * self.CHARS_PER_TOKEN / len(text)
+        scale = self.scale + self.SMOOTHING * (target - self.scale)
+        self.scale = min(max(scale, self.MIN_SCALE), self.MAX_SCALE)
 
 class ConversationManager:
     """Менеджер разговоров с оптимизацией памяти для Gemini"""
+    # Через сколько секунд неактивности разговор удаляется
+    INACTIVITY_TIMEOUT = 24 * 3600
+    # Насколько раньше удаляются короткие разговоры (T-LRU): разговор из одного
+    # сообщения живёт ~23 часа, полный — все 24
+    SHORT_HISTORY_PENALTY = 3600
+    
+    # Доля истории, освобождаемая за раз (вытеснение по длине, сжатие в сводку):
+    # префикс запроса остаётся побайтово неизменным несколько ходов подряд
+    # (кэш префикса Gemini)
+    TRIM_RATIO = 0.25
+    
+    # Роли Gemini; в истории хранится только индекс роли
+    ROLES = ("user", "model")
+    
     def __init__(self):
-        self.conversations: Dict[int, List[Dict]] = {}
-        self.last_activity: Dict[int, datetime] = {}
+        # Компактные записи (индекс роли, текст, токены, время добавления);
+        # формат Gemini собирается при запросе.
+        # Порядок OrderedDict — LRU: в конце самые недавно использованные разговоры
+        self.conversations: OrderedDict[int, Deque[Tuple[int, str, int, float]]] = OrderedDict()
+        # Сумма токенов истории, поддерживается при добавлении и удалении сообщений
+        self.total_tokens: Dict[int, int] = {}
+        self._expiry = ExpiryIndex()
     
-    def add_message(self, user_id: int, role: str, content: str):
-        """Добавление сообщения в разговор (Gemini format)"""
-        if user_id not in self.conversations:
-            self.conversations[user_id] = []
-        
+    def add_message(self, user_id: int, role: str, content: str, tokens: int = 0):
+        """Добавление сообщения в разговор (tokens — посчитанный один раз размер)"""
         # Gemini использует 'user' и 'model' роли
-        gemini_role = "user" if role == "user" else "model"
+        role_index = 0 if role == "user" else 1
         
-        self.conversations[user_id].append({
-            "role": gemini_role,
-            "parts": [{"text": content}]
-        })
+        # deque с maxlen сам отбрасывает самые старые сообщения
+        history = self.conversations.get(user_id)
+        if history is None:
+            history = self.conversations[user_id] = deque(maxlen=Config.MAX_CONVERSATION_LENGTH)
+        else:
+            self.conversations.move_to_end(user_id)
+            if len(history) == history.maxlen:
+                # Освобождаем место пачкой, а не по одному сообщению за ход;
+                # чётный размер сохраняет пары реплик user/model
+                batch = max(2, int(history.maxlen * self.TRIM_RATIO) // 2 * 2)
+                for _ in range(min(batch, len(history))):
+                    self.total_tokens[user_id] -= history.popleft()[2]
+        # Время последней активности — метка последнего сообщения, отдельный словарь не нужен
+        history.append((role_index, content, tokens, time.monotonic()))
+        self.total_tokens[user_id] = self.total_tokens.get(user_id, 0) + tokens
         
-        self.last_activity[user_id] = datetime.now()
+        # Жёсткий потолок памяти: вытесняем давно неиспользованные разговоры
+        while len(self.conversations) > Config.MAX_ACTIVE_CONVERSATIONS:
+            self.clear_conversation(next(iter(self.conversations)))
         
-        # Ограничиваем длину разговора
-        if len(self.conversations[user_id]) > Config.MAX_CONVERSATION_LENGTH:
-            self.conversations[user_id] = self.conversations[user_id][-Config.MAX_CONVERSATION_LENGTH:]
+        # Срок в куче обновляется лениво, при очистке
+        if user_id not in self._expiry:
+            self._expiry.schedule(user_id, self._expires_at(user_id))
     
     def get_conversation(self, user_id: int) -> List[Dict]:
         """Получение разговора пользователя в формате Gemini"""
-        return self.conversations.get(user_id, [])
+        history = self.conversations.get(user_id)
+        if history is None:
+            return []
+        self.conversations.move_to_end(user_id)
+        
+        roles = self.ROLES
+        return [
+            {"role": roles[role_index], "parts": [{"text": text}]}
+            for role_index, text, _, _ in history
+        ]
+    
+    def trim_to_token_budget(self, user_id: int, max_tokens: int):
+        """Удаление самых старых сообщений, пока история не уложится в бюджет токенов"""
+        history = self.conversations.get(user_id)
+        if history is None:
+            return
+        
+        # Только сохранённые счётчики, без повторного подсчёта всей истории.
+        # Запасной вариант после сводки, поэтому режем ровно до бюджета
+        total = self.total_tokens[user_id]
+        while total > max_tokens and len(history) > 1:
+            total -= history.popleft()[2]
+        self.total_tokens[user_id] = total
+    
+    def oldest_messages(self, user_id: int, count: int) -> List[Tuple[int, str, int, float]]:
+        """Первые count сообщений истории (для сжатия в сводку)"""
+        return list(islice(self.conversations.get(user_id, ()), count))
+    
+    def replace_oldest(self, user_id: int, messages: List[Tuple[int, str, int, float]], summary: str, tokens: int) -> bool:
+        """Замена первых сообщений истории одной сводкой, если они ещё на месте"""
+        history = self.conversations.get(user_id)
+        if history is None or len(history) <= len(messages):
+            return False
+        # Пока шёл запрос сводки, история могла измениться параллельным сообщением
+        if any(history[i] is not message for i, message in enumerate(messages)):
+            return False
+        
+        total = self.total_tokens[user_id]
+        for _ in messages:
+            total -= history.popleft()[2]
+        # Сводка наследует метку последнего сжатого сообщения
+        history.appendleft((0, summary, tokens, messages[-1][3]))
+        self.total_tokens[user_id] = total + tokens
+        return True
+    
+    def conversation_length(self, user_id: int) -> int:
+        """Количество сообщений в истории пользователя (без копирования)"""
+        return len(self.conversations.get(user_id, ()))
     
     def clear_conversation(self, user_id: int):
         """Очистка разговора пользователя"""
         if user_id in self.conversations:
             del self.conversations[user_id]
-        if user_id in self.last_activity:
-            del self.last_activity[user_id]
+        self.total_tokens.pop(user_id, None)
+        self._expiry.discard(user_id)
+    
+    def _expires_at(self, user_id: int) -> float:
+        """Срок удаления с учётом длины истории: короткие ценны меньше"""
+        history = self.conversations[user_id]
+        weight = math.log1p(len(history)) / math.log1p(max(Config.MAX_CONVERSATION_LENGTH, 1))
+        penalty = self.SHORT_HISTORY_PENALTY * (1 - min(weight, 1.0))
+        return history[-1][3] + self.INACTIVITY_TIMEOUT - penalty
     
     def cleanup_inactive_conversations(self):
         """Очистка неактивных разговоров"""
-        cutoff = datetime.now() - timedelta(hours=24)
-        users_to_remove = []
-        
-        for user_id, last_time in self.last_activity.items():
-            if last_time < cutoff:
-                users_to_remove.append(user_id)
+        now = time.monotonic()
+        removed = 0
         
-        for user_id in users_to_remove:
-            self.clear_conversation(user_id)
+        for user_id in self._expiry.pop_due(now):
+            expires_at = self._expires_at(user_id)
+            if expires_at > now:
+                # Пользователь был активен — переносим срок
+                self._expiry.schedule(user_id, expires_at)
+            else:
+                self.clear_conversation(user_id)
+                removed += 1
         
-        logger.info(f"🧹 Очищено {len(users_to_remove)} неактивных разговоров")
+        logger.info("🧹 Очищено %d неактивных разговоров", removed)
+
+def _build_welcome_template() -> str:
+    """Шаблон приветствия; подставляется только {user_name}"""
+    return f"""
+🤖 Привет, {{user_name}}! Я бот с Google Gemini 2.0! ✨
+
+📋 **Доступные команды:**
+/start - Показать это сообщение
+/clear - Очистить историю разговора
+/help - Подробная справка
+/status - Статус бота
+
+💬 Просто напишите мне сообщение, и я отвечу!
+
+⚡ Лимит: до {Config.RATE_LIMIT_REQUESTS} сообщений подряд, восстанавливается за {Config.RATE_LIMIT_MINUTES} мин.
+        """
+
+def _build_help_text() -> str:
+    """Текст /help с подставленной конфигурацией"""
+    return f"""
+🔧 **Подробная справка**
+
+**Команды:**
+/start - Начать работу с ботом
+/clear - Очистить историю разговора
+/help - Показать эту справку
+/status - Статус и статистика бота
+
+**Возможности:**
+• Умные ответы на любые вопросы
+• Помощь с программированием
+• Объяснение сложных концепций
+• Творческие задачи
+• Поддержка русского и английского языков
+
+**Ограничения:**
+• Сообщений подряд: до {Config.RATE_LIMIT_REQUESTS}, лимит полностью восстанавливается за {Config.RATE_LIMIT_MINUTES} мин.
+• Максимальная длина сообщения: {Config.MAX_MESSAGE_LENGTH} символов
+• История сохраняется до 24 часов
+
+💡 **Советы:**
+- Задавайте конкретные вопросы для лучших ответов
+- Используйте /clear если нужно сменить тему
+- Бот помнит контекст разговора
+        """
+
+def _build_status_template() -> str:
+    """Шаблон /status; подставляются только счётчики"""
+    return f"""
+📊 **Статус бота**
+
+🤖 Модель: gemini-2.5-pro
+🟢 Статус: Активен
+💬 Активных разговоров: {{active_conversations}}
+📝 Ваших сообщений в истории: {{user_messages}}
+
+⚙️ **Конфигурация:**
+• Лимит запросов: {Config.RATE_LIMIT_REQUESTS} подряд, +{Config.RATE_LIMIT_REQUESTS}/{Config.RATE_LIMIT_MINUTES}мин
+• Макс. длина сообщения: {Config.MAX_MESSAGE_LENGTH}
+• Макс. история: {Config.MAX_CONVERSATION_LENGTH} сообщений
+• Бюджет контекста: {Config.MAX_CONTEXT_TOKENS} токенов
+        """
+
+_SUMMARY_PROMPT = (
+    "Сожми следующую часть диалога в краткую сводку для памяти ассистента. "
+    "Сохрани факты, договорённости и вопросы пользователя; код и точные "
+    "значения приводи дословно. Отвечай только сводкой.\n\n"
+)
+
+# Метка ответа, оборванного посреди стрима (сохраняется в истории)
+_PARTIAL_REPLY_MARK = "\n\n[Ответ прерван]"
+
+# Причины остановки генерации Gemini
+_FinishReason = genai.protos.Candidate.FinishReason
+# Генерация завершилась штатно; иначе ответ считается прерванным
+_COMPLETE_FINISH_REASONS = (None, _FinishReason.FINISH_REASON_UNSPECIFIED, _FinishReason.STOP)
+
+# Ответ пользователю, если Gemini остановился, не выдав текста
+_SAFETY_STOP_TEXT = (
+    "🛡️ Ответ заблокирован фильтрами безопасности. "
+    "Попробуйте переформулировать вопрос."
+)
+_EMPTY_REPLY_TEXTS = {
+    _FinishReason.SAFETY: _SAFETY_STOP_TEXT,
+    _FinishReason.BLOCKLIST: _SAFETY_STOP_TEXT,
+    _FinishReason.PROHIBITED_CONTENT: _SAFETY_STOP_TEXT,
+    _FinishReason.SPII: _SAFETY_STOP_TEXT,
+    _FinishReason.RECITATION: (
+        "📚 Ответ слишком близко цитирует защищённый материал и был остановлен. "
+        "Попробуйте переформулировать вопрос."
+    ),
+    _FinishReason.MAX_TOKENS: (
+        "✂️ Ответ не уместился в лимит длины. "
+        "Попробуйте сузить вопрос или используйте /clear."
+    ),
+}
+_EMPTY_REPLY_DEFAULT = (
+    "🤷 Gemini не вернул ответ. "
+    "Попробуйте переформулировать вопрос или используйте /clear."
+)
+
+# Фильтр обычных текстовых сообщений; составной фильтр собирается один раз
+TEXT_MESSAGE_FILTER = filters.TEXT & ~filters.COMMAND
+
+# Config не меняется после запуска — собираем тексты ответов один раз
+_WELCOME_TEMPLATE = _build_welcome_template()
+_HELP_TEXT = _build_help_text()
+_STATUS_TEMPLATE = _build_status_template()
 
 class GeminiBot:
     def __init__(self):
@@ -156,102 +430,53 @@ class GeminiBot:
             safety_settings=safety_settings
         )
         
+        # Дешёвая модель для сжатия старой части истории
+        self.summary_model = genai.GenerativeModel(
+            model_name=Config.SUMMARY_MODEL,
+            safety_settings=safety_settings
+        )
+        
         self.conversation_manager = ConversationManager()
         self.rate_limiter = RateLimiter()
-        self._cleanup_task = None
+        self.token_estimator = TokenEstimator()
+        # Пользователи, для которых сейчас идёт запрос сводки
+        self._summarizing: Set[int] = set()
+        # Порог, с которого начало истории сжимается заранее, до упора в бюджет
+        self._compaction_threshold = Config.MAX_CONTEXT_TOKENS * (1 - ConversationManager.TRIM_RATIO)
+        # Открытые окна склейки: (chat_id, user_id) -> (тексты, пришедшие за окно,
+        # событие досрочного закрытия окна)
+        self._pending: Dict[Tuple[int, int], Tuple[List[str], asyncio.Event]] = {}
     
-    async def start_cleanup_task(self):
-        """Запуск задачи очистки после инициализации event loop"""
-        if self._cleanup_task is None:
-            self._cleanup_task = asyncio.create_task(self._periodic_cleanup())
-            logger.info("🧹 Задача периодической очистки запущена")
-    
-    async def _periodic_cleanup(self):
-        """Периодическая очистка данных"""
-        while True:
-            await asyncio.sleep(3600)  # Каждый час
-            try:
-                self.conversation_manager.cleanup_inactive_conversations()
-                self.rate_limiter.cleanup_old_data()
-                logger.info("🧹 Выполнена периодическая очистка данных")
-            except Exception as e:
-                logger.error(f"Ошибка при очистке данных: {e}")
+    async def cleanup_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Периодическая очистка данных (задача JobQueue)"""
+        try:
+            self.conversation_manager.cleanup_inactive_conversations()
+            self.rate_limiter.cleanup_old_data()
+            logger.info("🧹 Выполнена периодическая очистка данных")
+        except Exception as e:
+            logger.error("Ошибка при очистке данных: %s", e)
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
-        # Запускаем cleanup task при первом использовании
-        await self.start_cleanup_task()
-        
         user_name = update.effective_user.first_name or "друг"
-        welcome_message = f"""
-🤖 Привет, {user_name}! Я бот с Google Gemini 2.0! ✨
-
-📋 **Доступные команды:**
-/start - Показать это сообщение
-/clear - Очистить историю разговора
-/help - Подробная справка
-/status - Статус бота
-
-💬 Просто напишите мне сообщение, и я отвечу!
-
-⚡ Лимит: {Config.RATE_LIMIT_REQUESTS} сообщений в {Config.RATE_LIMIT_MINUTES} мин.
-        """
+        welcome_message = _WELCOME_TEMPLATE.format(user_name=user_name)
         await update.message.reply_text(welcome_message)
-        logger.info(f"👋 Новый пользователь: {update.effective_user.id}")
+        logger.info("👋 Новый пользователь: %s", update.effective_user.id)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /help"""
-        help_text = """
-🔧 **Подробная справка**
-
-**Команды:**
-/start - Начать работу с ботом
-/clear - Очистить историю разговора
-/help - Показать эту справку
-/status - Статус и статистика бота
-
-**Возможности:**
-• Умные ответы на любые вопросы
-• Помощь с программированием
-• Объяснение сложных концепций
-• Творческие задачи
-• Поддержка русского и английского языков
-
-**Ограничения:**
-• Максимум сообщений: {rate_limit} в {rate_minutes} мин.
-• Максимальная длина сообщения: {max_length} символов
-• История сохраняется в течение 24 часов
-
-💡 **Советы:**
-- Задавайте конкретные вопросы для лучших ответов
-- Используйте /clear если нужно сменить тему
-- Бот помнит контекст разговора
-        """.format(
-            rate_limit=Config.RATE_LIMIT_REQUESTS,
-            rate_minutes=Config.RATE_LIMIT_MINUTES,
-            max_length=Config.MAX_MESSAGE_LENGTH
-        )
-        await update.message.reply_text(help_text)
+        await update.message.reply_text(_HELP_TEXT)
     
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Статус бота"""
         active_conversations = len(self.conversation_manager.conversations)
         user_id = update.effective_user.id
-        user_messages = len(self.conversation_manager.get_conversation(user_id))
+        user_messages = self.conversation_manager.conversation_length(user_id)
         
-        status_text = f"""
-📊 **Статус бота**
-
-🤖 Модель: gemini-2.5-pro
-🟢 Статус: Активен
-💬 Активных разговоров: {active_conversations}
-📝 Ваших сообщений в истории: {user_messages}
-
-⚙️ **Конфигурация:**
-• Лимит запросов: {Config.RATE_LIMIT_REQUESTS}/{Config.RATE_LIMIT_MINUTES}мин
-• Макс. длина сообщения: {Config.MAX_MESSAGE_LENGTH}
-• Макс. история: {Config.MAX_CONVERSATION_LENGTH} сообщений
-        """
+        status_text = _STATUS_TEMPLATE.format(
+            active_conversations=active_conversations,
+            user_messages=user_messages
+        )
         await update.message.reply_text(status_text)
     
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -259,112 +484,289 @@ class GeminiBot:
         user_id = update.effective_user.id
         self.conversation_manager.clear_conversation(user_id)
         await update.message.reply_text("✅ История разговора очищена! Можете начать с чистого листа.")
-        logger.info(f"🗑️ Пользователь {user_id} очистил историю")
+        logger.info("🗑️ Пользователь %s очистил историю", user_id)
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка обычных сообщений"""
-        # Запускаем cleanup task при первом использовании
-        await self.start_cleanup_task()
-        
+        # Разворачиваем цепочки атрибутов PTB один раз
+        message = update.message
         user_id = update.effective_user.id
-        user_message = update.message.text
+        user_message = message.text
+        conversation_manager = self.conversation_manager
         
-        # Проверка лимита запросов
-        if not self.rate_limiter.is_allowed(user_id):
-            await update.message.reply_text(
-                f"⏰ Превышен лимит запросов! "
-                f"Максимум {Config.RATE_LIMIT_REQUESTS} сообщений в {Config.RATE_LIMIT_MINUTES} минуту. "
-                f"Попробуйте чуть позже."
-            )
+        # Пустые сообщения не отправляем в Gemini
+        if not user_message or user_message.isspace():
             return
         
-        # Проверка длины сообщения
+        # Проверка длины сообщения (до лимита: отклонённое не тратит квоту)
         if len(user_message) > Config.MAX_MESSAGE_LENGTH:
-            await update.message.reply_text(
+            await message.reply_text(
                 f"📝 Сообщение слишком длинное! "
                 f"Максимум {Config.MAX_MESSAGE_LENGTH} символов. "
                 f"Ваше: {len(user_message)} символов."
             )
             return
         
-        # Отправляем индикатор печати
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+        # Проверка лимита запросов (склеиваемые сообщения тоже учитываются)
+        if not self.rate_limiter.is_allowed(user_id):
+            await message.reply_text(
+                f"⏰ Превышен лимит запросов! "
+                f"Можно до {Config.RATE_LIMIT_REQUESTS} сообщений подряд; "
+                f"лимит восстанавливается постепенно за {Config.RATE_LIMIT_MINUTES} мин. "
+                f"Попробуйте чуть позже."
+            )
+            return
+        
+        # Сообщение, пришедшее пока окно склейки открыто, уходит в тот же запрос,
+        # если склеенный текст не превысит лимит длины
+        pending_key = (message.chat_id, user_id)
+        pending = self._pending.get(pending_key)
+        if pending is not None:
+            texts, closed = pending
+            merged_len = sum(map(len, texts)) + 2 * len(texts) + len(user_message)
+            if merged_len <= Config.MAX_MESSAGE_LENGTH:
+                texts.append(user_message)
+                return
+            # Не влезает: закрываем окно досрочно, чтобы накопленное ушло в историю
+            # раньше этого сообщения, а оно само откроет новое окно
+            closed.set()
+            del self._pending[pending_key]
+        
+        # Индикатор печати отправляется параллельно с запросом к Gemini,
+        # а не отдельным round-trip перед ним
+        typing_task = asyncio.create_task(
+            self._keep_typing(context.bot, message.chat_id)
+        )
         
         try:
-            # Добавляем сообщение пользователя в историю
-            self.conversation_manager.add_message(user_id, "user", user_message)
+            # Короткое окно склейки (включается COALESCE_WINDOW_MS): быстрые
+            # последовательные сообщения пользователя в чате — один запрос к Gemini
+            if Config.COALESCE_WINDOW_MS > 0:
+                window = texts, closed = [user_message], asyncio.Event()
+                self._pending[pending_key] = window
+                try:
+                    await asyncio.wait_for(closed.wait(), Config.COALESCE_WINDOW_MS / 1000)
+                except asyncio.TimeoutError:
+                    pass  # Окно истекло штатно
+                finally:
+                    if self._pending.get(pending_key) is window:
+                        del self._pending[pending_key]
+                user_message = "\n\n".join(texts)
+            
+            # Добавляем сообщение пользователя в историю; токены оцениваются
+            # локально, без обращения к API
+            user_tokens = self.token_estimator.estimate(user_message)
+            conversation_manager.add_message(user_id, "user", user_message, user_tokens)
+            # Сообщение переполнило бюджет: сначала сжимаем начало истории в сводку,
+            # обрезка ниже — лишь запасной вариант
+            if conversation_manager.total_tokens[user_id] > Config.MAX_CONTEXT_TOKENS:
+                await self._compact_history(user_id)
+            # Пока сводку делает параллельное сообщение, не обрезаем: она заменит начало
+            if user_id not in self._summarizing:
+                conversation_manager.trim_to_token_budget(user_id, Config.MAX_CONTEXT_TOKENS)
             
             # Получаем историю разговора
-            conversation_history = self.conversation_manager.get_conversation(user_id)
+            conversation_history = conversation_manager.get_conversation(user_id)
             
-            # Отправляем запрос к Gemini
-            if conversation_history:
-                # Если есть история, используем chat
-                chat = self.model.start_chat(history=conversation_history[:-1])  # Исключаем последнее сообщение
-                response = await asyncio.to_thread(
-                    chat.send_message, 
-                    user_message
-                )
+            # Отправляем запрос к Gemini в режиме стриминга (нативный async-клиент)
+            response = await self.model.generate_content_async(
+                conversation_history, stream=True
+            )
+            
+            # Получаем ответ, отправляя части по мере готовности
+            gemini_response = await self._stream_reply(message, user_id, response)
+            
+            # Добавляем ответ в историю; точный размер ответа есть в usage_metadata,
+            # им же калибруем локальную оценку для следующих сообщений
+            reply_tokens = response.usage_metadata.candidates_token_count
+            if reply_tokens:
+                self.token_estimator.calibrate(gemini_response, reply_tokens)
             else:
-                # Первое сообщение
-                response = await asyncio.to_thread(
-                    self.model.generate_content,
-                    user_message
-                )
+                reply_tokens = self.token_estimator.estimate(gemini_response)
+            conversation_manager.add_message(user_id, "assistant", gemini_response, reply_tokens)
             
-            # Получаем ответ
-            gemini_response = response.text
+            logger.info("✅ Ответ отправлен пользователю %s", user_id)
             
-            # Добавляем ответ в историю
-            self.conversation_manager.add_message(user_id, "assistant", gemini_response)
+        except TelegramError as e:
+            # Ошибка на стороне Telegram (сеть, BadRequest): ожидаемая, без трассировки;
+            # повторная отправка сообщения об ошибке, скорее всего, тоже не пройдёт
+            logger.warning("Ошибка Telegram для пользователя %s: %s", user_id, e)
             
-            # Разбиваем длинные ответы на части
-            if len(gemini_response) > Config.MAX_MESSAGE_LENGTH:
-                chunks = [
-                    gemini_response[i:i+Config.MAX_MESSAGE_LENGTH] 
-                    for i in range(0, len(gemini_response), Config.MAX_MESSAGE_LENGTH)
-                ]
-                for i, chunk in enumerate(chunks):
-                    if i > 0:
-                        await asyncio.sleep(0.5)  # Небольшая пауза между частями
-                    await update.message.reply_text(chunk)
-            else:
-                await update.message.reply_text(gemini_response)
+        except google_exceptions.ResourceExhausted:
+            await message.reply_text(
+                "⚠️ Превышен лимит запросов к Gemini API. "
+                "Попробуйте через несколько минут."
+            )
+            logger.warning("Gemini quota exceeded для пользователя %s", user_id)
             
-            logger.info(f"✅ Ответ отправлен пользователю {user_id}")
+        except StopCandidateException as e:
+            # Gemini остановился, не выдав текста: у каждой причины своё сообщение
+            candidate = e.args[0] if e.args else None
+            finish_reason = candidate.finish_reason if candidate is not None else None
+            await message.reply_text(_EMPTY_REPLY_TEXTS.get(finish_reason, _EMPTY_REPLY_DEFAULT))
+            logger.warning(
+                "Gemini вернул пустой ответ пользователю %s: %s",
+                user_id, getattr(finish_reason, "name", finish_reason)
+            )
             
-        except Exception as e:
-            error_msg = str(e).lower()
+        except BlockedPromptException:
+            await message.reply_text(
+                "🛡️ Сообщение заблокировано фильтрами безопасности. "
+                "Попробуйте переформулировать вопрос."
+            )
+            logger.warning("Gemini safety filter для пользователя %s", user_id)
             
-            if "quota" in error_msg or "limit" in error_msg:
-                await update.message.reply_text(
-                    "⚠️ Превышен лимит запросов к Gemini API. "
-                    "Попробуйте через несколько минут."
-                )
-                logger.warning(f"Gemini quota exceeded для пользователя {user_id}")
-                
-            elif "safety" in error_msg or "blocked" in error_msg:
-                await update.message.reply_text(
-                    "🛡️ Сообщение заблокировано фильтрами безопасности. "
-                    "Попробуйте переформулировать вопрос."
-                )
-                logger.warning(f"Gemini safety filter для пользователя {user_id}")
+        except google_exceptions.GoogleAPICallError as e:
+            await message.reply_text(
+                "❌ Ошибка Gemini API. Попробуйте позже или используйте /clear для сброса контекста."
+            )
+            logger.error("Gemini API error: %s", e)
+            
+        except Exception as e:
+            await message.reply_text(
+                "❌ Произошла неожиданная ошибка. Попробуйте еще раз или используйте /clear."
+            )
+            # Трассировка нужна только для действительно неизвестных ошибок
+            logger.error("Unexpected error for user %s: %s", user_id, e, exc_info=True)
+        
+        finally:
+            typing_task.cancel()
+        
+        # Сжимаем старую часть истории уже после ответа, чтобы не задерживать его,
+        # и заранее, пока история ещё не упёрлась в бюджет
+        if conversation_manager.total_tokens.get(user_id, 0) > self._compaction_threshold:
+            await self._compact_history(user_id)
+    
+    async def _compact_history(self, user_id: int):
+        """Сжатие начала истории; для пользователя одновременно идёт не больше одной сводки"""
+        if user_id in self._summarizing:
+            return
+        self._summarizing.add(user_id)
+        try:
+            await self._summarize_oldest(user_id, self._compaction_threshold)
+        finally:
+            self._summarizing.discard(user_id)
+    
+    async def _summarize_oldest(self, user_id: int, target_tokens: float):
+        """Сжатие начала истории в сводку вместо её удаления: не меньше четверти
+        и столько, чтобы остаток уложился в target_tokens"""
+        history_len = self.conversation_manager.conversation_length(user_id)
+        history = self.conversation_manager.oldest_messages(user_id, history_len)
+        min_count = max(2, history_len // 4)
+        count = 0
+        remaining = self.conversation_manager.total_tokens.get(user_id, 0)
+        for index, (role_index, _, tokens, _) in enumerate(history):
+            # Сводка хранится как реплика пользователя, поэтому сжатый префикс
+            # должен заканчиваться перед репликой модели
+            if role_index == 1 and index >= min_count:
+                count = index
+                if remaining <= target_tokens:
+                    break
+            remaining -= tokens
+        if not count:
+            return
+        
+        prefix = history[:count]
+        roles = ConversationManager.ROLES
+        transcript = "\n\n".join(f"{roles[role_index]}: {text}" for role_index, text, _, _ in prefix)
+        
+        try:
+            response = await self.summary_model.generate_content_async(_SUMMARY_PROMPT + transcript)
+            summary = f"[Краткое содержание начала разговора: {response.text}]"
+        except Exception as e:
+            # Не страшно: trim_to_token_budget просто отбросит старые сообщения
+            logger.warning("Не удалось сжать историю пользователя %s: %s", user_id, e)
+            return
+        
+        if self.conversation_manager.replace_oldest(user_id, prefix, summary, self.token_estimator.estimate(summary)):
+            logger.info("🗜️ Сжато %d сообщений истории пользователя %s", count, user_id)
+    
+    async def _keep_typing(self, bot, chat_id: int):
+        """Поддержка индикатора печати, пока идёт генерация (Telegram гасит его через ~5с)"""
+        while True:
+            try:
+                await bot.send_chat_action(chat_id=chat_id, action="typing")
+            except Exception as e:
+                logger.debug("Не удалось отправить индикатор печати: %s", e)
+            await asyncio.sleep(4)
+
+    async def _stream_reply(self, message: Message, user_id: int, response) -> str:
+        """Отправка стримингового ответа Gemini частями по MAX_MESSAGE_LENGTH"""
+        limit = Config.MAX_MESSAGE_LENGTH
+        received: List[str] = []
+        # Неотправленный хвост копится списком и склеивается только перед отправкой
+        pending: List[str] = []
+        pending_len = 0
+        # Части, которые пользователь уже получил
+        sent: List[str] = []
+        
+        try:
+            async for chunk in response:
+                # chunk.text бросает исключение на пустом финальном чанке
+                text = "".join(part.text for part in chunk.parts)
+                if not text:
+                    continue
+                received.append(text)
+                pending.append(text)
+                pending_len += len(text)
                 
-            elif "api" in error_msg:
-                await update.message.reply_text(
-                    "❌ Ошибка Gemini API. Попробуйте позже или используйте /clear для сброса контекста."
+                # Отправляем готовые части, не дожидаясь конца генерации
+                if pending_len >= limit:
+                    buffered = "".join(pending)
+                    while len(buffered) >= limit:
+                        await self._send_part(message, buffered[:limit])
+                        sent.append(buffered[:limit])
+                        buffered = buffered[limit:]
+                    pending = [buffered] if buffered else []
+                    pending_len = len(buffered)
+            
+            candidates = response.candidates
+            candidate = candidates[0] if candidates else None
+            if not received:
+                # Пустой ответ — ожидаемый исход (фильтр, цитирование, лимит токенов);
+                # response.text здесь не читаем: он бросает безликий ValueError
+                raise StopCandidateException(candidate)
+            
+            if pending:
+                tail = "".join(pending)
+                await self._send_part(message, tail)
+                sent.append(tail)
+            reply = "".join(received)
+            
+            # Генерация оборвана после части текста: показываем и сохраняем как прерванную
+            if candidate is not None and candidate.finish_reason not in _COMPLETE_FINISH_REASONS:
+                logger.warning(
+                    "Ответ пользователю %s прерван: %s",
+                    user_id, getattr(candidate.finish_reason, "name", candidate.finish_reason)
                 )
-                logger.error(f"Gemini API error: {e}")
-                
-            else:
-                await update.message.reply_text(
-                    "❌ Произошла неожиданная ошибка. Попробуйте еще раз или используйте /clear."
+                await self._send_part(message, _PARTIAL_REPLY_MARK.strip())
+                reply += _PARTIAL_REPLY_MARK
+            return reply
+        except Exception:
+            # Обрыв посреди ответа (Gemini или Telegram): уже отправленное сохраняем
+            # в истории, чтобы следующий ход мог продолжить его, а не генерировать заново
+            if sent:
+                partial = "".join(sent) + _PARTIAL_REPLY_MARK
+                self.conversation_manager.add_message(
+                    user_id, "assistant", partial, self.token_estimator.estimate(partial)
                 )
-                logger.error(f"Unexpected error for user {user_id}: {e}")
-
+            raise
+    
+    async def _send_part(self, message: Message, text: str, attempts: int = 3):
+        """Отправка части ответа; при flood control ждём столько, сколько просит Telegram"""
+        for attempt in range(attempts):
+            try:
+                await message.reply_text(text)
+                return
+            except RetryAfter as e:
+                if attempt == attempts - 1:
+                    raise
+                logger.warning("Flood control Telegram, повтор через %s с", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+    
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Глобальный обработчик ошибок"""
-        logger.error(f"Update {update} caused error {context.error}")
+        logger.error("Update %s caused error %s", update, context.error)
         
         if update and update.message:
             try:
@@ -374,6 +776,16 @@ class GeminiBot:
             except Exception:
                 pass  # Игнорируем ошибки при отправке сообщения об ошибке
 
+async def log_pending_updates(application: Application):
+    """Логирование числа накопившихся обновлений, которые будут пропущены при старте"""
+    try:
+        info = await application.bot.get_webhook_info()
+    except Exception as e:
+        logger.warning("Не удалось получить число ожидающих обновлений: %s", e)
+        return
+    if info.pending_update_count:
+        logger.info("⏭️ Пропускаем %d накопившихся обновлений", info.pending_update_count)
+
 def create_application():
     """Создание приложения Telegram"""
     # Валидация конфигурации
@@ -386,6 +798,18 @@ def create_application():
     application = (Application.builder()
                   .token(Config.TELEGRAM_BOT_TOKEN)
                   .concurrent_updates(True)  # Параллельная обработка
+                  # Пул соединений для ответов, чтобы параллельные
+                  # send_chat_action/reply_text не ждали друг друга
+                  .connection_pool_size(256)
+                  .pool_timeout(20)
+                  .connect_timeout(10)
+                  .read_timeout(30)
+                  # HTTP/2: параллельные запросы мультиплексируются в одном соединении
+                  .http_version("2")
+                  # Отдельный пул для long polling
+                  .get_updates_connection_pool_size(1)
+                  .get_updates_pool_timeout(60)
+                  .post_init(log_pending_updates)
                   .build())
     
     # Добавляем обработчики
@@ -393,11 +817,21 @@ def create_application():
     application.add_handler(CommandHandler("help", bot.help_command))
     application.add_handler(CommandHandler("status", bot.status_command))
     application.add_handler(CommandHandler("clear", bot.clear_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
+    application.add_handler(MessageHandler(TEXT_MESSAGE_FILTER, bot.handle_message))
     
     # Добавляем обработчик ошибок
     application.add_error_handler(bot.error_handler)
     
+    # Периодическая очистка через JobQueue; jitter разносит запуски
+    # нескольких экземпляров бота во времени
+    application.job_queue.run_repeating(
+        bot.cleanup_job,
+        interval=300,
+        first=60,
+        name="cleanup",
+        job_kwargs={"jitter": 30}
+    )
+    
     return application
 
 def main():
@@ -405,6 +839,14 @@ def main():
     try:
         logger.info("🚀 Запуск Gemini Telegram Bot...")
         
+        # uvloop (если установлен) ускоряет event loop; run_polling подхватит политику
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("⚡ Используется uvloop")
+        except ImportError:
+            pass
+        
         # Создаем приложение
         application = create_application()
         
@@ -413,10 +855,13 @@ def main():
         
         if os.getenv("PELLA_APP") == "true":
             # Режим для Pella.app
-            logger.info(f"🌐 Запуск в режиме Pella.app на порту {port}")
+            logger.info("🌐 Запуск в режиме Pella.app на порту %s", port)
             application.run_polling(
                 allowed_updates=Update.ALL_TYPES,
                 drop_pending_updates=True,
+                timeout=30,  # Длинный long polling: меньше запросов getUpdates
+                poll_interval=0.0,
+                bootstrap_retries=-1,
                 close_loop=False
             )
         else:
@@ -424,11 +869,14 @@ def main():
             logger.info("💻 Запуск в локальном режиме")
             application.run_polling(
                 allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True
+                drop_pending_updates=True,
+                timeout=30,  # Длинный long polling: меньше запросов getUpdates
+                poll_interval=0.0,
+                bootstrap_retries=-1
             )
             
     except Exception as e:
-        logger.error(f"❌ Критическая ошибка при запуске: {e}")
+        logger.error("❌ Критическая ошибка при запуске: %s", e)
         raise
 
 if __name__ == '__main__':
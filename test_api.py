@@ -1,17 +1,29 @@
 import anthropic
+import asyncio
+import httpx
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+# Ограниченное время ожидания и без повторов: проверка не зависает, если API недоступен
+client = anthropic.AsyncAnthropic(
+    api_key=os.getenv("ANTHROPIC_API_KEY"),
+    timeout=httpx.Timeout(5.0, connect=2.0),
+    max_retries=0,
+)
 
-try:
-    response = client.messages.create(
-        model="claude-3-5-sonnet-20241022",
-        max_tokens=100,
-        messages=[{"role": "user", "content": "Привет!"}]
-    )
-    print("API работает:", response.content[0].text)
-except Exception as e:
-    print("Ошибка API:", e)
\ No newline at end of file
+async def main():
+    try:
+        response = await client.messages.create(
+            model="claude-3-5-haiku-20241022",
+            max_tokens=16,
+            messages=[{"role": "user", "content": "Привет!"}]
+        )
+        print("API работает:", response.content[0].text)
+    except Exception as e:
+        print("Ошибка API:", e)
+    finally:
+        await client.close()
+
+asyncio.run(main())